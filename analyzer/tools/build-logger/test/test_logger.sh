@@ -2,18 +2,61 @@
 
 #--- Initialize environment ---#
 
-logger_dir=$1
+# The tests change the working directory, so it must be an absolute path.
+logger_dir=$(cd "$1" && pwd)
 
-export LD_PRELOAD=ldlogger.so
+# LD_PRELOAD is only set for the commands started by run_logged, so the
+# helper programs of the tests (mktemp, diff, od, the built a.out, ...) do
+# not load the logger for nothing.
+logger_preload=ldlogger.so
 export LD_LIBRARY_PATH=$logger_dir/lib:$LD_LIBRARY_PATH
 export CC_LOGGER_GCC_LIKE="gcc:g++:clang:clang++:cc:c++"
-export CC_LOGGER_FILE=/tmp/logger_test_compilation_database.json
-export CC_LOGGER_DEBUG_FILE=/tmp/logger_test_debug.log
 
 source_file_name=logger_test_source.cpp
-source_file=/tmp/$source_file_name
-response_file=/tmp/logger_test_source.cpp.rsp
-reference_file=/tmp/logger_test_reference.json
+
+# Full paths of the compilers called by the tests, looked up only once
+# instead of running which in every test. A compiler which is not found
+# gets an empty path, assert_json fails for it.
+declare -A compiler_paths
+for compiler in gcc g++ clang; do
+  compiler_paths[$compiler]=$(type -P $compiler)
+done
+
+# The first g++-* compiler found in the PATH, shared by the compiler path
+# tests. Globbing the PATH directories stops at the first hit without
+# starting a process or descending into subdirectories.
+IFS=':' read -ra path_dirs <<< "$PATH"
+versioned_gpp=
+for dir in "${path_dirs[@]}"; do
+  for compiler in "$dir"/g++-*; do
+    if [ -f "$compiler" ]; then
+      versioned_gpp=$compiler
+      break 2
+    fi
+  done
+done
+
+# The source file is shared by all tests, the directories of the tests are
+# created next to it. The logger records the physical working directory,
+# so symbolic links in TMPDIR are resolved.
+# The trap is only installed once run_dir surely is the new directory, an
+# empty mktemp result would make it the working directory of the caller.
+tmp_dir=$(mktemp -d "${TMPDIR:-/tmp}/logger_test_XXXXXX") || exit 1
+run_dir=$(cd "$tmp_dir" && pwd -P) || exit 1
+trap 'rm -rf "$run_dir"' EXIT
+source_file=$run_dir/$source_file_name
+
+# The paths as they have to be written into the command lines parsed by
+# $logged_shell, in case TMPDIR contains shell metacharacters.
+printf -v quoted_run_dir %q "$run_dir"
+printf -v quoted_source_file %q "$source_file"
+
+# The logger escapes the spaces of the paths in the command of the
+# compilation database, so spaces in TMPDIR are expected that way.
+json_source_file=${source_file// /\\\\ }
+
+# CC_LOGGER_FILE, CC_LOGGER_DEBUG_FILE, response_file and reference_file are
+# placed into a separate directory for every test, see run_test.
 
 # Notes about testing:
 # Examine the actual argv of the gcc:
@@ -21,79 +64,141 @@ reference_file=/tmp/logger_test_reference.json
 # Examine the output of the created binary:
 #   ./a.out | od -An -vtx1
 
+# Shell used for the commands which really need one. dash starts up faster
+# than bash.
+logged_shell=$(type -P dash || echo /bin/sh)
+
+# Runs the command in a preloaded process which execs the compiler.
+# Several arguments are the argv of the command and are started by env
+# as they are, which saves the start of a whole shell. A single argument is
+# a command line which needs a shell, it is parsed by $logged_shell.
+# The logger writes its entry before the compiler is exec'd, so the callers
+# must check the returned status to notice that the compiler did not run.
+# arg1...: the arguments of the command, or the command line as a string
+function run_logged {
+  if [ $# -gt 1 ]; then
+    LD_PRELOAD=$logger_preload env "$@"
+  else
+    LD_PRELOAD=$logger_preload $logged_shell -c "$1"
+  fi
+}
+
 # arg1: expected stdout text as hexdump
 # arg2: name of the executable
 function assert_run_stdout_hexdump {
-  # run the binary, then convert the output to hex
-  # remove the very first space character, flatten the text
-  # then remove any trailing whitespaces.
-  actual_hex_output=`"$2" | od -An -vtx1 | sed 's/^ //' | tr '\n' ' ' | sed 's/\s*$//'`
-  diff <(echo -n "$actual_hex_output") <(echo -n "$1")
+  # run the binary, then convert the output to hex on a single line
+  # and remove the very first space character.
+  actual_hex_output=$("$2" | od -An -vtx1 -w1024)
+  actual_hex_output=${actual_hex_output# }
+
+  if [ "$actual_hex_output" != "$1" ]; then
+    echo "Expected output: $1"
+    echo "Actual output:   $actual_hex_output"
+    return 1
+  fi
 }
 
-function assert_json {
-  cat > $reference_file << EOF
-[
+# The logger does not end the compilation database with a newline, so the
+# reference is written the same way instead of appending one to the
+# database before every comparison.
+json_format='[
 	{
-		"directory": "$(pwd)",
-		"command": "$(which $2) $1",
-		"file": "$3"
+		"directory": "%s",
+		"command": "%s",
+		"file": "%s"
 	}
-]
-EOF
+]'
+
+# arg1: expected arguments of the compiler
+# arg2: name or absolute path of the compiler
+# arg3: expected source file
+function assert_json {
+  local compiler=$2
+  if [[ $compiler != /* ]]; then
+    compiler=${compiler_paths[$compiler]}
+    if [ -z "$compiler" ]; then
+      echo "Compiler not found in PATH: $2"
+      return 1
+    fi
+  fi
 
-  sed -i -e '$a\' $CC_LOGGER_FILE
+  printf "$json_format" "$PWD" "$compiler $1" "$3" > "$reference_file"
 
-  diff $reference_file $CC_LOGGER_FILE
-  test -s $CC_LOGGER_DEBUG_FILE
+  # diff is only needed to show the differences.
+  if ! cmp -s "$reference_file" "$CC_LOGGER_FILE"; then
+    diff "$reference_file" "$CC_LOGGER_FILE"
+    return 1
+  fi
+  test -s "$CC_LOGGER_DEBUG_FILE"
 }
 
-#--- Test functions ---#
+# arg1: extended regular expression to search for in the compilation database
+function assert_json_matches {
+  local json
+  IFS= read -rd '' json < "$CC_LOGGER_FILE"
+  [[ $json =~ $1 ]]
+}
 
-function test_compiler_path1 {
-  IFS=':' read -ra my_array <<< $PATH
-  compiler=$(find ${my_array[@]} -name g++-* -print -quit)
+# arg1: string to search for in the compilation database, taken literally
+function assert_json_contains {
+  local json
+  IFS= read -rd '' json < "$CC_LOGGER_FILE"
+  [[ $json == *"$1"* ]]
+}
 
-  if [ -n $compiler ]; then
-    CC_LOGGER_GCC_LIKE="g++-" bash -c "$compiler $source_file"
-    assert_json "$source_file" $compiler "$source_file"
-  fi
+# Nothing to parse in a database without entries, so it is compared as a
+# string instead of writing a reference file and running diff.
+function assert_empty_json {
+  local json
+  IFS= read -rd '' json < "$CC_LOGGER_FILE"
+  [ "$json" = $'[\n]' ]
 }
 
-function test_compiler_path2 {
-  IFS=':' read -ra my_array <<< $PATH
-  compiler=$(find ${my_array[@]} -name g++-* -print -quit)
+# The commands are JSON strings, so the paths cannot contain a quote.
+abs_include_regex='-I/[^"]*hello'
+abs_include_space_regex='-I /[^"]*hello'
+abs_isystem_regex='-isystem=/[^"]*hello'
 
-  if [ -n $compiler ]; then
-    CC_LOGGER_GCC_LIKE="/g++-" bash -c "$compiler $source_file"
+#--- Test functions ---#
 
-    echo -ne "[\n]" > $reference_file
-    diff $reference_file $CC_LOGGER_FILE
-  fi
+function test_compiler_path1 {
+  CC_LOGGER_GCC_LIKE="g++-" run_logged "$versioned_gpp" "$source_file" || return 1
+  assert_json "$json_source_file" "$versioned_gpp" "$source_file"
+}
+
+function test_compiler_path2 {
+  CC_LOGGER_GCC_LIKE="/g++-" run_logged "$versioned_gpp" "$source_file" || return 1
+  assert_empty_json
 }
 
+# Without a g++-* compiler there is nothing to test, so these are not even
+# started instead of each creating its test directory for nothing.
+if [ -z "$versioned_gpp" ]; then
+  unset -f test_compiler_path1 test_compiler_path2
+fi
+
 function test_simple {
-  bash -c "g++ $source_file"
+  run_logged g++ "$source_file" || return 1
 
-  assert_json "$source_file" g++ "$source_file"
+  assert_json "$json_source_file" g++ "$source_file"
 }
 
 function test_cpath {
   CPATH=path1 \
-  bash -c "g++ $source_file"
+  run_logged g++ "$source_file" || return 1
 
   assert_json \
-    "-I path1 $source_file" \
+    "-I path1 $json_source_file" \
     g++ \
     "$source_file"
 }
 
 function test_cpath_after_last_I {
   CPATH=":path1:path2:" \
-  bash -c "g++ -I p0 $source_file -I p1 -I p2"
+  run_logged g++ -I p0 "$source_file" -I p1 -I p2 || return 1
 
   assert_json \
-    "-I p0 $source_file -I p1 -I p2 -I . -I path1 -I path2 -I ." \
+    "-I p0 $json_source_file -I p1 -I p2 -I . -I path1 -I path2 -I ." \
     g++ \
     "$source_file"
 }
@@ -101,10 +206,10 @@ function test_cpath_after_last_I {
 function test_cplus {
   CPLUS_INCLUDE_PATH="path1:path2" \
   C_INCLUDE_PATH="path3:path4" \
-  bash -c "g++ -I p0 -isystem p1 $source_file"
+  run_logged g++ -I p0 -isystem p1 "$source_file" || return 1
 
   assert_json \
-    "-I p0 -isystem p1 -isystem path1 -isystem path2 $source_file" \
+    "-I p0 -isystem p1 -isystem path1 -isystem path2 $json_source_file" \
     g++ \
     "$source_file"
 }
@@ -112,10 +217,10 @@ function test_cplus {
 function test_c {
   CPLUS_INCLUDE_PATH="path1:path2" \
   C_INCLUDE_PATH="path3:path4" \
-  bash -c "gcc -I p0 -isystem p1 $source_file"
+  run_logged gcc -I p0 -isystem p1 "$source_file" || return 1
 
   assert_json \
-    "-I p0 -isystem p1 -isystem path3 -isystem path4 $source_file" \
+    "-I p0 -isystem p1 -isystem path3 -isystem path4 $json_source_file" \
     gcc \
     "$source_file"
 }
@@ -123,61 +228,61 @@ function test_c {
 function test_cpp {
   CPLUS_INCLUDE_PATH="path1:path2" \
   C_INCLUDE_PATH="path3:path4" \
-  bash -c "gcc -I p0 -isystem p1 -x c++ $source_file"
+  run_logged gcc -I p0 -isystem p1 -x c++ "$source_file" || return 1
 
   assert_json \
-    "-I p0 -isystem p1 -isystem path1 -isystem path2 -x c++ $source_file" \
+    "-I p0 -isystem p1 -isystem path1 -isystem path2 -x c++ $json_source_file" \
     gcc \
     "$source_file"
 }
 
 function test_space {
-  bash -c "gcc -DVARIABLE='hello world' $source_file"
+  run_logged gcc "-DVARIABLE=hello world" "$source_file" || return 1
 
   assert_json \
-    "-DVARIABLE=hello\\\\ world $source_file" \
+    "-DVARIABLE=hello\\\\ world $json_source_file" \
     gcc \
     "$source_file"
 }
 
 function test_quote {
-  bash -c "gcc -DVARIABLE=\\\"hello\\\" $source_file"
+  run_logged gcc '-DVARIABLE="hello"' "$source_file" || return 1
 
   assert_json \
-    "-DVARIABLE=\\\\\\\"hello\\\\\\\" $source_file" \
+    "-DVARIABLE=\\\\\\\"hello\\\\\\\" $json_source_file" \
     gcc \
     "$source_file"
 }
 
 function test_space_quote {
-  bash -c "gcc -DVARIABLE=\\\"hello\\ world\\\" $source_file"
+  run_logged gcc '-DVARIABLE="hello world"' "$source_file" || return 1
 
   assert_json \
-    "-DVARIABLE=\\\\\\\"hello\\\\ world\\\\\\\" $source_file" \
+    "-DVARIABLE=\\\\\\\"hello\\\\ world\\\\\\\" $json_source_file" \
     gcc \
     "$source_file"
 }
 
 function test_backslashes_new {
   CC_LOGGER_NEW_ESCAPING="anything" \
-  bash -c "gcc -Wall -Wextra -DVARIABLE=\\\\\\\\\\\\\\\\built\\\\\\\\ages\\ \\\"ago\\\"\\\\\\\\ $source_file"
+  run_logged "gcc -Wall -Wextra -DVARIABLE=\\\\\\\\\\\\\\\\built\\\\\\\\ages\\ \\\"ago\\\"\\\\\\\\ $quoted_source_file" || return 1
 
   assert_json \
-    "-Wall -Wextra -DVARIABLE=\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\built\\\\\\\\\\\\\\\\ages\\\\ \\\\\\\"ago\\\\\\\"\\\\\\\\\\\\\\\\ $source_file" \
+    "-Wall -Wextra -DVARIABLE=\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\built\\\\\\\\\\\\\\\\ages\\\\ \\\\\\\"ago\\\\\\\"\\\\\\\\\\\\\\\\ $json_source_file" \
     gcc \
-    "$source_file"
+    "$source_file" || return 1
 
   #                          -  -  \  \  b  u  i  l  t  \  a  g  e  s     "  a  g  o  "  \  -  -
   assert_run_stdout_hexdump "2d 2d 5c 5c 62 75 69 6c 74 5c 61 67 65 73 20 22 61 67 6f 22 5c 2d 2d"  ./a.out
 }
 
 function test_backslashes_old {
-  bash -c "gcc -Wall -Wextra -DVARIABLE=\\\\\\\\\\\\\\\\built\\\\\\\\ages\\ \\\"ago\\\"\\\\\\\\ $source_file"
+  run_logged "gcc -Wall -Wextra -DVARIABLE=\\\\\\\\\\\\\\\\built\\\\\\\\ages\\ \\\"ago\\\"\\\\\\\\ $quoted_source_file" || return 1
 
   assert_json \
-    "-Wall -Wextra -DVARIABLE=\\\\\\\\\\\\\\\\\\\\\\\\built\\\\\\\\\\\\ages\\\\ \\\\\\\"ago\\\\\\\"\\\\\\\\\\\\ $source_file" \
+    "-Wall -Wextra -DVARIABLE=\\\\\\\\\\\\\\\\\\\\\\\\built\\\\\\\\\\\\ages\\\\ \\\\\\\"ago\\\\\\\"\\\\\\\\\\\\ $json_source_file" \
     gcc \
-    "$source_file"
+    "$source_file" || return 1
 
   #                          -  -  \  \  b  u  i  l  t  \  a  g  e  s     "  a  g  o  "  \  -  -
   assert_run_stdout_hexdump "2d 2d 5c 5c 62 75 69 6c 74 5c 61 67 65 73 20 22 61 67 6f 22 5c 2d 2d"  ./a.out
@@ -185,12 +290,12 @@ function test_backslashes_old {
 
 function test_vectical_tab_new {
   CC_LOGGER_NEW_ESCAPING="anything" \
-  bash -c "gcc -Wall -Wextra -DVARIABLE=\\\\\\\\ZZ\\\\x0bYYYY\\\\\\\\ $source_file"
+  run_logged "gcc -Wall -Wextra -DVARIABLE=\\\\\\\\ZZ\\\\x0bYYYY\\\\\\\\ $quoted_source_file" || return 1
 
   assert_json \
-    "-Wall -Wextra -DVARIABLE=\\\\\\\\\\\\\\\\ZZ\\\\\\\\x0bYYYY\\\\\\\\\\\\\\\\ $source_file" \
+    "-Wall -Wextra -DVARIABLE=\\\\\\\\\\\\\\\\ZZ\\\\\\\\x0bYYYY\\\\\\\\\\\\\\\\ $json_source_file" \
     gcc \
-    "$source_file"
+    "$source_file" || return 1
 
   # --\ZZ\vYYYY\-- as hex
   #      ^^ ---- vertical tab --------------vv
@@ -199,12 +304,12 @@ function test_vectical_tab_new {
 }
 
 function test_vectical_tab_old {
-  bash -c "gcc -Wall -Wextra -DVARIABLE=\\\\\\\\ZZ\\\\x0bYYYY\\\\\\\\ $source_file"
+  run_logged "gcc -Wall -Wextra -DVARIABLE=\\\\\\\\ZZ\\\\x0bYYYY\\\\\\\\ $quoted_source_file" || return 1
 
   assert_json \
-    "-Wall -Wextra -DVARIABLE=\\\\\\\\\\\\ZZ\\\\\\x0bYYYY\\\\\\\\\\\\ $source_file" \
+    "-Wall -Wextra -DVARIABLE=\\\\\\\\\\\\ZZ\\\\\\x0bYYYY\\\\\\\\\\\\ $json_source_file" \
     gcc \
-    "$source_file"
+    "$source_file" || return 1
 
   # --\ZZ\vYYYY\-- as hex
   #      ^^ ---- vertical tab --------------vv
@@ -214,12 +319,12 @@ function test_vectical_tab_old {
 
 function test_carriage_return_new {
   CC_LOGGER_NEW_ESCAPING="anything" \
-  bash -c "gcc -Wall -Wextra -DVARIABLE=\\\\\\\\ZZ\\\\x0dYYYY\\\\\\\\ $source_file"
+  run_logged "gcc -Wall -Wextra -DVARIABLE=\\\\\\\\ZZ\\\\x0dYYYY\\\\\\\\ $quoted_source_file" || return 1
 
   assert_json \
-    "-Wall -Wextra -DVARIABLE=\\\\\\\\\\\\\\\\ZZ\\\\\\\\x0dYYYY\\\\\\\\\\\\\\\\ $source_file" \
+    "-Wall -Wextra -DVARIABLE=\\\\\\\\\\\\\\\\ZZ\\\\\\\\x0dYYYY\\\\\\\\\\\\\\\\ $json_source_file" \
     gcc \
-    "$source_file"
+    "$source_file" || return 1
 
   # --\ZZ\rYYYY\-- as hex
   #      ^^ ---- carriage return -----------vv
@@ -228,12 +333,12 @@ function test_carriage_return_new {
 }
 
 function test_carriage_return_old {
-  bash -c "gcc -Wall -Wextra -DVARIABLE=\\\\\\\\ZZ\\\\x0dYYYY\\\\\\\\ $source_file"
+  run_logged "gcc -Wall -Wextra -DVARIABLE=\\\\\\\\ZZ\\\\x0dYYYY\\\\\\\\ $quoted_source_file" || return 1
 
   assert_json \
-    "-Wall -Wextra -DVARIABLE=\\\\\\\\\\\\ZZ\\\\\\x0dYYYY\\\\\\\\\\\\ $source_file" \
+    "-Wall -Wextra -DVARIABLE=\\\\\\\\\\\\ZZ\\\\\\x0dYYYY\\\\\\\\\\\\ $json_source_file" \
     gcc \
-    "$source_file"
+    "$source_file" || return 1
 
   # --\ZZ\rYYYY\-- as hex
   #      ^^ ---- carriage return -----------vv
@@ -242,81 +347,145 @@ function test_carriage_return_old {
 }
 
 function test_response_file {
-  echo "-I p0 -isystem p1" > $response_file
-  bash -c "clang @$response_file $source_file"
+  echo "-I p0 -isystem p1" > "$response_file"
+  run_logged clang "@$response_file" "$source_file" || return 1
 
-  assert_json "@$response_file $source_file" clang "$source_file"
+  assert_json "@$json_response_file $json_source_file" clang "$source_file"
 }
 
 function test_response_file_contain_source_file {
-  echo "-I p0 -isystem p1 $source_file" > $response_file
-  bash -c "clang @$response_file"
+  echo "-I p0 -isystem p1 $quoted_source_file" > "$response_file"
+  run_logged clang "@$response_file" || return 1
 
-  assert_json "@$response_file" clang "@$response_file"
+  assert_json "@$json_response_file" clang "@$response_file"
 }
 
 function test_compiler_abs {
-  bash -c "/usr/bin/gcc $source_file"
+  run_logged /usr/bin/gcc "$source_file" || return 1
 
   assert_json \
-    "$source_file" \
+    "$json_source_file" \
     /usr/bin/gcc \
     "$source_file"
 }
 
 function test_include_abs1 {
-  CC_LOGGER_ABS_PATH=1 bash -c "gcc -Ihello $source_file"
-  grep -- -I/.*hello $CC_LOGGER_FILE &> /dev/null
+  CC_LOGGER_ABS_PATH=1 run_logged gcc -Ihello "$source_file" || return 1
+  assert_json_matches "$abs_include_regex"
 }
 
 function test_include_abs2 {
-  CC_LOGGER_ABS_PATH=1 bash -c "gcc -I hello $source_file"
-  grep -- "-I /.*hello" $CC_LOGGER_FILE &> /dev/null
+  CC_LOGGER_ABS_PATH=1 run_logged gcc -I hello "$source_file" || return 1
+  assert_json_matches "$abs_include_space_regex"
 }
 
 function test_include_abs3 {
-  CC_LOGGER_ABS_PATH=1 bash -c "gcc -isystem=hello $source_file"
-  grep -- "-isystem=/.*hello" $CC_LOGGER_FILE &> /dev/null
+  CC_LOGGER_ABS_PATH=1 run_logged gcc -isystem=hello "$source_file" || return 1
+  assert_json_matches "$abs_isystem_regex"
 }
 
 function test_source_abs {
-  CC_LOGGER_ABS_PATH=1 bash -c "cd /tmp && gcc $source_file_name"
-  grep -- "$source_file" $CC_LOGGER_FILE &> /dev/null
+  CC_LOGGER_ABS_PATH=1 run_logged "cd $quoted_run_dir && gcc $source_file_name" || return 1
+  assert_json_contains "\"$source_file\""
 }
 
 function test_valid_json {
-  bash -c "gcc 2>/dev/null"
-  echo -ne "[\n]" > $reference_file
-
-  diff $reference_file $CC_LOGGER_FILE
+  # gcc fails without an input file, only a missing gcc is an error here.
+  run_logged "gcc 2>/dev/null"
+  [ $? -lt 126 ] || return 1
+  assert_empty_json
 }
 
 
 #--- Run tests ---#
 
-cat > $source_file << EOF
-#include <stdio.h>
+# Written by the echo builtin, no cat process is needed for a few lines.
+echo '#include <stdio.h>
 
 #define xstr(a) str(a)
 #define str(a) #a
 
 int main() {
   printf("--%s--", xstr(VARIABLE));
+}' > "$source_file"
+
+# Runs the test in its fresh temporary directory which is also the working
+# directory of the test, so the created a.out does not collide either.
+# The directories are not removed one by one, the whole $run_dir is removed
+# when the script exits.
+# arg1: name of the test function
+# arg2: directory of the test
+function run_test {
+  test_dir=$2
+
+  export CC_LOGGER_FILE=$test_dir/compilation_database.json
+  export CC_LOGGER_DEBUG_FILE=$test_dir/debug.log
+  response_file=$test_dir/$source_file_name.rsp
+  json_response_file=${response_file// /\\\\ }
+  reference_file=$test_dir/reference.json
+
+  cd "$test_dir"
+  $1
 }
-EOF
 
-for func in $(declare -F); do
-  if [[ $func =~ test_ ]]; then
-    rm -f $CC_LOGGER_FILE
-    rm -rf $CC_LOGGER_DEBUG_FILE
-    $func
+# Every test runs in its own subshell, at most $jobs of them at the same time.
+# The output of a test goes to a file in its directory and is only printed
+# when the test fails, so the outputs of parallel tests do not interleave.
+jobs=${LOGGER_TEST_JOBS:-$(nproc)}
+declare -A names
+declare -A dirs
+failed=0
+
+# Reports the result of the test, which its subshell wrote to the status
+# file of its directory. A test without a status file was killed.
+# arg1: pid of the test
+function finish_test {
+  local status=
+  read -r status 2> /dev/null < "${dirs[$1]}/status"
+  if [ "$status" != 0 ]; then
+    echo Test failed: ${names[$1]}
+    cat "${dirs[$1]}/output"
+    failed=1
+  fi
+  unset "names[$1]" "dirs[$1]"
+}
 
-    if [ $? -ne 0 ]; then
-      echo Test failed: $func
-      rm a.out
-      exit 1
-    fi
+# Waits for whichever running test finishes first. wait -p, which would
+# tell the pid, needs bash 5.1, so plain wait -n (bash 4.3) only waits for
+# an exit, and the finished tests are found by their status files, or by
+# their process being gone.
+function wait_test {
+  local pid
+  local found=
+  while [ -z "$found" ]; do
+    wait -n
+    for pid in "${!names[@]}"; do
+      if [ -f "${dirs[$pid]}/status" ] || ! kill -0 $pid 2> /dev/null; then
+        finish_test $pid
+        found=1
+      fi
+    done
+  done
+}
+
+# compgen lists the test functions by name prefix, the way a test loader
+# would, instead of filtering every word of the declare -F output.
+for func in $(compgen -A function test_); do
+  if [ ${#names[@]} -ge $jobs ]; then
+    wait_test
   fi
+
+  dir=$(mktemp -d "$run_dir/${func}_XXXXXX")
+  {
+    run_test $func "$dir"
+    echo $? > "$dir/status"
+  } > "$dir/output" 2>&1 &
+  names[$!]=$func
+  dirs[$!]=$dir
+done
+
+while [ ${#names[@]} -gt 0 ]; do
+  wait_test
 done
 
-rm -f a.out
+exit $failed